@@ -0,0 +1,19 @@
+# app/core/cache.py
+
+from diskcache import Cache
+from .config import settings
+import os
+
+# Persistent caches of OpenAI results. diskcache is backed by SQLite, so entries
+# survive restarts and are shared by every worker on the host.
+column_mapping_cache = Cache(os.path.join(settings.CACHE_DIR, "column_mappings"))
+
+# HS Code -> unit of measure results returned by OpenAI. The lookup is a pure
+# function of the code, so entries never expire. If the size limit is reached the
+# least frequently used codes go first. Hits served by a worker's in-process copy
+# (see openai_client) do not reach this cache, so its access counts only reflect
+# lookups that missed that copy.
+uom_cache = Cache(
+    os.path.join(settings.CACHE_DIR, "units_of_measure"),
+    eviction_policy="least-frequently-used",
+)
@@ -2,7 +2,20 @@
 
 from pydantic_settings import BaseSettings
 from pathlib import Path
-from typing import Dict, List
+from types import MappingProxyType
+from typing import Final, Mapping, Tuple
+
+# Standard column mappings: each standard column and the header variations that map to it.
+# Read-only and built once at import, outside the validated settings.
+STANDARD_COLUMNS: Final[Mapping[str, Tuple[str, ...]]] = MappingProxyType({
+    "Export Invoice #": ("Export Invoice #", "Export Document", "Export Invoice Number", "Invoice Number", "Invoice #"),
+    "Product Code": ("Style", "Item", "Product Style", "Style/Item/Style/Product Style", "Product Code", "Style Code"),
+    "Description": ("Description", "Item Description", "Product Description", "desc", "product_desc", "item_description"),
+    "Invoice Quantity": ("Quantity", "QTY", "Invoice Qty", "Qty", "quantity", "Invoice Quantity"),
+    "Total Amount": ("Total Amount", "Amount US$", "Amount", "Total", "total", "total_price", "amount", "Price"),
+    "HS Code": ("HS Code", "Customs Nomenclature", "Tariff Code", "HTS", "Harmonized Code"),
+    # "Customs Unit of Measure" and "Customs Quantity" will be derived fields
+})
 
 class Settings(BaseSettings):
     PROJECT_NAME: str = "Invoice Processor"
@@ -10,6 +23,9 @@ class Settings(BaseSettings):
     
     # Directory for temporary file storage
     UPLOAD_DIR: str = str(Path("uploads").absolute())
+
+    # Directory for persistent caches of OpenAI results
+    CACHE_DIR: str = str(Path("cache").absolute())
     
     # Supabase settings
     SUPABASE_URL: str
@@ -18,18 +34,10 @@ class Settings(BaseSettings):
     
     # OpenAI settings
     OPENAI_API_KEY: str
-    
-    # Standard column mappings
-    STANDARD_COLUMNS: Dict[str, List[str]] = {
-        "Export Invoice #": ["Export Invoice #", "Export Document", "Export Invoice Number", "Invoice Number", "Invoice #"],
-        "Product Code": ["Style", "Item", "Product Style", "Style/Item/Style/Product Style", "Product Code", "Style Code"],
-        "Description": ["Description", "Item Description", "Product Description", "desc", "product_desc", "item_description"],
-        "Invoice Quantity": ["Quantity", "QTY", "Invoice Qty", "Qty", "quantity", "Invoice Quantity"],
-        "Total Amount": ["Total Amount", "Amount US$", "Amount", "Total", "total", "total_price", "amount", "Price"],
-        "HS Code": ["HS Code", "Customs Nomenclature", "Tariff Code", "HTS", "Harmonized Code"],
-        # "Customs Unit of Measure" and "Customs Quantity" will be derived fields
-    }
 
+    # Maximum number of in-flight OpenAI requests; size to the account's rate limits
+    OPENAI_MAX_CONCURRENCY: int = 20
+    
     class Config:
         env_file = ".env"
         extra = "allow"
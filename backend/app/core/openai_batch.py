@@ -0,0 +1,96 @@
+# app/core/openai_batch.py
+
+import json
+import logging
+from typing import Dict, List
+from .openai_client import client, build_unit_of_measure_request, validate_unit
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# Batch statuses after which the batch will not make further progress
+FAILED_BATCH_STATUSES = {"failed", "expired", "cancelled"}
+
+async def submit_hs_batch(hs_codes: List[str]) -> str:
+    """
+    Submit unit of measure lookups for the given HS Codes to the OpenAI Batch API.
+
+    Args:
+        hs_codes (List[str]): The unique HS Codes to look up.
+
+    Returns:
+        str: The ID of the created batch.
+    """
+    rows = [
+        json.dumps({
+            "custom_id": hs_code,
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": build_unit_of_measure_request(hs_code),
+        })
+        for hs_code in hs_codes
+    ]
+    batch_file = ("hs_batch.jsonl", "\n".join(rows).encode("utf-8"))
+
+    input_file = await client.files.create(file=batch_file, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+    logger.info(f"Submitted HS Code batch {batch.id} with {len(hs_codes)} requests")
+    return batch.id
+
+async def poll_batch(batch_id: str) -> str:
+    """
+    Return the current status of a batch (e.g. 'in_progress', 'completed', 'failed').
+    """
+    batch = await client.batches.retrieve(batch_id)
+    return batch.status
+
+async def cancel_batch(batch_id: str) -> None:
+    """
+    Cancel a batch that will not be tracked, so it is not left running and billed.
+    """
+    await client.batches.cancel(batch_id)
+    logger.info(f"Cancelled HS Code batch {batch_id}")
+
+async def fetch_results(batch_id: str) -> Dict[str, str]:
+    """
+    Download the output of a completed batch.
+
+    Args:
+        batch_id (str): The ID of a completed batch.
+
+    Returns:
+        Dict[str, str]: Mapping of each successfully answered HS Code to its customs unit of measure abbreviation.
+    """
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        raise ValueError(f"Batch {batch_id} has no results (status: {batch.status})")
+    if not batch.output_file_id:
+        # Every request in the batch failed; the codes fall back to the real-time lookup
+        logger.error(f"Batch {batch_id} completed without any successful responses")
+        return {}
+
+    content = await client.files.content(batch.output_file_id)
+
+    units = {}
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        hs_code = result["custom_id"]
+        try:
+            body = result["response"]["body"]
+            unit = validate_unit(body["choices"][0]["message"]["content"], hs_code)
+        except (KeyError, IndexError, TypeError):
+            unit = None
+        if unit is None:
+            # Leave the code out so it falls back to the real-time lookup
+            logger.error(f"Batch {batch_id} returned no usable response for HS Code '{hs_code}': {result.get('error')}")
+        else:
+            units[hs_code] = unit
+
+    return units
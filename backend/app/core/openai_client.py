@@ -1,75 +1,409 @@
 # app/core/openai_client.py
 
-from openai import OpenAI
+from openai import AsyncOpenAI, RateLimitError, APITimeoutError, APIConnectionError
+from fuzzywuzzy import fuzz
+import asyncio
+import hashlib
 import json
-from typing import List, Dict
-from functools import lru_cache
-from tenacity import retry, wait_exponential, stop_after_attempt
-from .config import settings
+import re
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Dict, Mapping, Optional, Sequence, Tuple
+from tenacity import retry, retry_if_exception_type, wait_exponential, stop_after_attempt
+from .config import settings, STANDARD_COLUMNS
+from .cache import column_mapping_cache, uom_cache
 import logging
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 
-# Instantiate the OpenAI client correctly
-client = OpenAI(api_key=settings.OPENAI_API_KEY)
+# Instantiate the async OpenAI client so requests are awaited directly on the event loop
+client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
 
-@retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(3))
-def get_unit_of_measure(hs_code: str) -> str:
+# Bound the number of in-flight OpenAI requests to stay under the account's RPM/TPM limits
+_sem = asyncio.Semaphore(settings.OPENAI_MAX_CONCURRENCY)
+
+# Minimum fuzz.ratio score (0-100) for mapping a header to a standard column locally.
+# Kept high: looser scores map unrelated headers such as "Invoice Date" or "Unit Price"
+FUZZY_MATCH_CUTOFF = 90
+
+# Accepted customs unit of measure abbreviations
+VALID_UNITS = {"NUM", "DOZ", "KG", "LBS"}
+
+# Known HS Code prefix (chapter, heading or subheading) -> unit of measure, from the HTS units of quantity.
+# The table takes precedence over OpenAI, so a chapter is only listed when every heading in it
+# uses the same unit; otherwise its headings are listed individually
+with open(Path(__file__).resolve().parent.parent / "data" / "hs_uom.json") as f:
+    _HS_UOM: Dict[str, str] = json.load(f)
+
+# In-process copy of the most recently used units of the persistent cache, so repeat
+# lookups in a worker skip SQLite. It is bounded, so codes that drop out of it are read
+# from (and counted by) the persistent cache again
+UOM_MEMORY_SIZE = 1024
+_uom_memory: "OrderedDict[str, str]" = OrderedDict()
+
+# HS Codes per real-time unit of measure request, keeping each response (about 20 tokens
+# per code) well within gpt-4o-mini's 16,384 output token limit
+UOM_BATCH_SIZE = 100
+
+def lookup_unit_of_measure(hs_code: str) -> Optional[str]:
+    """
+    Look up the unit of measure for an HS Code in the local table by its
+    6, 4 or 2 digit prefix. Returns None if the code is not covered.
+    """
+    code = str(hs_code).strip()
+    digits = re.sub(r"\D", "", code)
+    # Numeric cells lose the trailing zero of the subheading, e.g. 6109.10 is read as 6109.1
+    if re.fullmatch(r"\d{4}\.\d", code):
+        digits += "0"
+
+    return _HS_UOM.get(digits[:6]) or _HS_UOM.get(digits[:4]) or _HS_UOM.get(digits[:2])
+
+def remember_unit_of_measure(hs_code: str, unit: str) -> None:
+    """
+    Keep a unit in the in-process copy, evicting the least recently used code when full.
+    """
+    _uom_memory[hs_code] = unit
+    _uom_memory.move_to_end(hs_code)
+    if len(_uom_memory) > UOM_MEMORY_SIZE:
+        _uom_memory.popitem(last=False)
+
+def get_cached_unit_of_measure(hs_code: str) -> Optional[str]:
+    """
+    Return the unit of measure for an HS Code from the in-process copy of the
+    cache, falling back to the persistent cache. Returns None if neither has it.
+    """
+    unit = _uom_memory.get(hs_code)
+    if unit is None:
+        unit = uom_cache.get(hs_code)
+    if unit is not None:
+        remember_unit_of_measure(hs_code, unit)
+    return unit
+
+def get_known_unit_of_measure(hs_code: str) -> Optional[str]:
     """
-    Use OpenAI to determine the customs unit of measure based on the HS Code.
+    Return the unit of measure for an HS Code from the local table or the cache,
+    or None if OpenAI has to be asked.
     """
-    if not hs_code or pd.isna(hs_code):
-        return "NUM"  # Default to NUM if no HS code
+    return lookup_unit_of_measure(hs_code) or get_cached_unit_of_measure(hs_code)
 
+def build_unit_of_measure_request(hs_code: str) -> Dict:
+    """
+    Build the chat completion request body used to look up the unit of measure for an HS Code
+    in a Batch API submission.
+    """
     prompt = f"""
     For HS Code '{hs_code}', provide ONLY the standard customs unit of measure abbreviation.
     Use one of: NUM (Number), DOZ (Dozen), KG (Kilogram), LBS (Pounds).
     Respond with ONLY the abbreviation.
     """
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": "You are a customs unit of measure assistant. Respond only with unit abbreviations: NUM, DOZ, KG, or LBS."},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0,
+        "max_tokens": 10,
+        "n": 1,
+    }
+
+def validate_unit(unit: str, hs_code: str) -> Optional[str]:
+    """
+    Normalize a unit returned by OpenAI. Returns None if it is not one of our accepted
+    units, so the answer is not cached and the code is looked up again next time.
+    """
+    unit = str(unit).strip().upper()
+    if unit not in VALID_UNITS:
+        logger.warning(f"Unexpected unit format '{unit}' for HS Code '{hs_code}'.")
+        return None
+    return unit
+
+@retry(
+    wait=wait_exponential(multiplier=1, min=2, max=10),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError)),
+    reraise=True,
+)
+async def request_units_of_measure(hs_codes: List[str]) -> Dict[str, str]:
+    """
+    Ask OpenAI for the customs unit of measure of up to UOM_BATCH_SIZE HS Codes in a single request.
+
+    Args:
+        hs_codes (List[str]): Non-blank HS Codes to look up.
+
+    Returns:
+        Dict[str, str]: Mapping of each HS Code answered with a valid unit to that unit.
+    """
+    prompt = f"""
+    For each of the following HS Codes, provide ONLY the standard customs unit of measure abbreviation.
+    Use one of: NUM (Number), DOZ (Dozen), KG (Kilogram), LBS (Pounds).
+
+    HS Codes: {json.dumps(hs_codes)}
+
+    Return ONLY a JSON object mapping every HS Code to its abbreviation.
+    Example response format:
+    {{"6109.10": "DOZ", "8471.30": "NUM"}}
+    """
+
+    async with _sem:
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": "You are a customs unit of measure assistant. Respond only with unit abbreviations: NUM, DOZ, KG, or LBS."},
+                {"role": "system", "content": "You are a customs unit of measure assistant. Respond only with a JSON object whose values are unit abbreviations: NUM, DOZ, KG, or LBS."},
                 {"role": "user", "content": prompt}
             ],
+            response_format={"type": "json_object"},
             temperature=0,
-            max_tokens=10,
+            max_tokens=20 * len(hs_codes) + 20,
             n=1,
         )
 
-        unit = response.choices[0].message.content.strip().upper()
-        
-        # Validate the response is one of our accepted units
-        valid_units = {"NUM", "DOZ", "KG", "LBS"}
-        if unit not in valid_units:
-            logger.warning(f"Unexpected unit format '{unit}' for HS Code '{hs_code}'. Defaulting to 'NUM'.")
-            return "NUM"
-        
-        return unit
+    try:
+        mappings = json.loads(response.choices[0].message.content.strip())
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse JSON response from OpenAI: {e}")
+        logger.error(f"Raw content: {response.choices[0].message.content}")
+        mappings = {}
 
-    except Exception as e:
-        logger.error(f"Error getting unit of measure for HS Code '{hs_code}': {str(e)}")
-        return "NUM"  # Default to NUM in case of any errors
+    # Keep only the codes answered with one of our accepted units
+    units = {}
+    for hs_code in hs_codes:
+        if hs_code not in mappings:
+            logger.warning(f"No unit of measure returned for HS Code '{hs_code}'")
+            continue
+        unit = validate_unit(mappings[hs_code], hs_code)
+        if unit is not None:
+            units[hs_code] = unit
 
-@lru_cache(maxsize=1024)
-def get_unit_of_measure_cached(hs_code: str) -> str:
+    return units
+
+async def get_units_of_measure_batch(hs_codes: List[str]) -> Dict[str, str]:
     """
-    Cached version of get_unit_of_measure to reduce API calls.
+    Use OpenAI to determine the customs unit of measure for several HS Codes. Codes are sent
+    UOM_BATCH_SIZE per request, so the response stays within the model's output token limit,
+    and the requests run concurrently.
 
     Args:
-        hs_code (str): The HS Code from the invoice.
+        hs_codes (List[str]): The HS Codes from the invoice.
 
     Returns:
-        str: The customs unit of measure abbreviation.
+        Dict[str, str]: Mapping of each HS Code to its customs unit of measure abbreviation.
+        Codes OpenAI gave no valid unit for (missing, renamed or truncated in the response,
+        or in a request that failed) are left out, so they are not cached.
+    """
+    units = {}
+    lookup_codes = []
+    for hs_code in hs_codes:
+        if not hs_code or pd.isna(hs_code) or hs_code == 'nan':
+            units[hs_code] = "NUM"  # Default to NUM if no HS code
+        else:
+            lookup_codes.append(hs_code)
+
+    chunks = [lookup_codes[i:i + UOM_BATCH_SIZE] for i in range(0, len(lookup_codes), UOM_BATCH_SIZE)]
+    results = await asyncio.gather(*(request_units_of_measure(chunk) for chunk in chunks), return_exceptions=True)
+
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error getting units of measure for HS Codes {chunk}: {str(result)}")
+            continue
+        units.update(result)
+
+    return units
+
+def get_uncached_hs_codes(hs_codes: List[str]) -> List[str]:
     """
-    return get_unit_of_measure(hs_code)
+    Return the HS Codes whose unit of measure is neither in the local table nor cached.
+    """
+    return [hs_code for hs_code in hs_codes if get_known_unit_of_measure(hs_code) is None]
 
-def get_column_mappings(headers: List[str], standard_columns: Dict[str, List[str]]) -> Dict[str, str]:
+def cache_units_of_measure(units: Dict[str, str]) -> None:
+    """
+    Store HS Code -> unit of measure results, e.g. from the Batch API, in the persistent cache.
     """
-    Use OpenAI to intelligently map source Excel columns to standard columns.
+    with uom_cache.transact():
+        for hs_code, unit in units.items():
+            uom_cache.set(hs_code, unit)
+    for hs_code, unit in units.items():
+        remember_unit_of_measure(hs_code, unit)
+
+async def get_units_of_measure_cached(hs_codes: List[str]) -> Dict[str, str]:
+    """
+    Cached version of get_units_of_measure_batch. Only HS Codes that are not in the
+    local table and have not been seen before are sent to OpenAI.
+
+    Args:
+        hs_codes (List[str]): The HS Codes from the invoice.
+
+    Returns:
+        Dict[str, str]: Mapping of each HS Code to its customs unit of measure abbreviation.
+    """
+    # Partition into hits and misses with a single cache read per code
+    units = {}
+    misses = []
+    for hs_code in hs_codes:
+        unit = get_known_unit_of_measure(hs_code)
+        if unit is None:
+            misses.append(hs_code)
+        else:
+            units[hs_code] = unit
+
+    if misses:
+        # Failed requests are logged per chunk and their codes are left out
+        fetched = await get_units_of_measure_batch(misses)
+        cache_units_of_measure(fetched)
+        units.update(fetched)
+
+        # Default to NUM for codes without an answer, without caching the fallback
+        for hs_code in misses:
+            units.setdefault(hs_code, "NUM")
+
+    return units
+
+# The rules and known variations are identical for every request, so they are built once
+# at import and sent as the system message; only the columns vary per request. At about
+# 200 tokens the prefix is below OpenAI's 1024-token prompt caching minimum, so this
+# does not get cached-input pricing
+_variations = "\n".join(
+    f"{standard}: {', '.join(variations)}" for standard, variations in STANDARD_COLUMNS.items()
+)
+COLUMN_MAPPING_SYSTEM_PROMPT = f"""You are a precise data mapping assistant.
+
+Task: Map Excel columns to standard column names.
+
+Known variations of each standard column:
+{_variations}
+
+Rules:
+1. Map source columns to the target standard columns based on best match
+2. Use exact matches when possible
+3. Use semantic matching for unclear cases
+4. Include only valid mappings
+5. If no valid mappings are found, return an empty list of mappings"""
+
+def build_column_mapping_schema(standard_columns: Mapping[str, Sequence[str]]) -> Dict:
+    """
+    Build the structured outputs schema for column mappings: a list of source/target
+    pairs whose targets are restricted to the standard column names.
+    """
+    return {
+        "name": "column_mappings",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "mappings": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "source": {"type": "string"},
+                            "target": {"type": "string", "enum": list(standard_columns.keys())},
+                        },
+                        "required": ["source", "target"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["mappings"],
+            "additionalProperties": False,
+        },
+    }
+
+def match_columns_locally(headers: List[str], standard_columns: Mapping[str, Sequence[str]]) -> Dict[str, str]:
+    """
+    Map headers to standard columns without OpenAI, by a strict case-insensitive
+    similarity (fuzz.ratio) against the standard names and their variations.
+    Each standard column is claimed only by its best-scoring header; ties, losing
+    headers and headers below the cutoff are left out for OpenAI to map.
+    """
+    variants = {
+        variant.lower(): standard
+        for standard, variations in standard_columns.items()
+        for variant in [standard, *variations]
+    }
+
+    # Standard column -> (score, header) of each header whose best match it is.
+    # A header whose best score is shared by several standard columns is ambiguous
+    claims: Dict[str, List[Tuple[int, str]]] = {}
+    for header in headers:
+        key = header.strip().lower()
+        scores: Dict[str, int] = {}
+        for variant, standard in variants.items():
+            score = fuzz.ratio(key, variant)
+            if score >= FUZZY_MATCH_CUTOFF and score > scores.get(standard, 0):
+                scores[standard] = score
+        if not scores:
+            continue
+        best_score = max(scores.values())
+        best_standards = [standard for standard, score in scores.items() if score == best_score]
+        if len(best_standards) == 1:
+            claims.setdefault(best_standards[0], []).append((best_score, header))
+
+    mappings = {}
+    for standard, candidates in claims.items():
+        best_score = max(score for score, _ in candidates)
+        winners = [header for score, header in candidates if score == best_score]
+        if len(winners) == 1:
+            mappings[winners[0]] = standard
+    return mappings
+
+@retry(
+    wait=wait_exponential(multiplier=1, min=2, max=10),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError)),
+    reraise=True,
+)
+async def request_column_mappings(headers: List[str], standard_columns: Mapping[str, Sequence[str]]) -> Dict[str, str]:
+    """
+    Ask OpenAI to map headers to standard columns. Returns an empty mapping if the
+    response cannot be parsed.
+    """
+    # Identical header layouts (and standard columns) always map the same way,
+    # so the OpenAI response is cached under a fingerprint of both
+    cache_key = hashlib.sha256(
+        json.dumps([headers, dict(standard_columns)], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    content = column_mapping_cache.get(cache_key)
+    if content is not None:
+        return json.loads(content)
+
+    prompt = f"""
+    Source columns: {', '.join(headers)}
+    Target standard columns: {', '.join(standard_columns.keys())}
+    """
+
+    async with _sem:
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": COLUMN_MAPPING_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_schema", "json_schema": build_column_mapping_schema(standard_columns)},
+            temperature=0,
+            max_tokens=300,
+            n=1,
+        )
+
+    content = response.choices[0].message.content.strip()
+    try:
+        # Structured outputs return a list of pairs; cache them in the flat source -> target form
+        pairs = json.loads(content)["mappings"]
+        mappings = {pair["source"]: pair["target"] for pair in pairs}
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        logger.error(f"Failed to parse JSON response from OpenAI: {e}")
+        logger.error(f"Raw content: {content}")
+        return {}
+
+    column_mapping_cache.set(cache_key, json.dumps(mappings))
+    return mappings
+
+async def get_column_mappings(headers: List[str], standard_columns: Mapping[str, Sequence[str]]) -> Dict[str, str]:
+    """
+    Map source Excel columns to standard columns, locally where possible and
+    with OpenAI for the remaining headers.
     """
     # First, try to get the actual content of the first row for unnamed columns
     cleaned_headers = []
@@ -82,59 +416,32 @@ def get_column_mappings(headers: List[str], standard_columns: Dict[str, List[str
         else:
             cleaned_headers.append(header_str)
 
-    # Prepare variations for prompt
-    variations = "\n".join([f"{standard}: {', '.join(variants)}" for standard, variants in standard_columns.items()])
+    mappings = match_columns_locally(cleaned_headers, standard_columns)
 
-    prompt = f"""
-    Task: Map Excel columns to standard column names.
+    # Only headers and standard columns that are still unmatched go to OpenAI
+    residual_headers = [header for header in cleaned_headers if header not in mappings]
+    residual_columns = {
+        standard: variations
+        for standard, variations in standard_columns.items()
+        if standard not in mappings.values()
+    }
+    if residual_headers and residual_columns:
+        logger.info(f"Asking OpenAI to map unmatched columns: {residual_headers}")
+        mappings.update(await request_column_mappings(residual_headers, residual_columns))
 
-    Source columns: {', '.join(cleaned_headers)}
-    Target standard columns: {', '.join(standard_columns.keys())}
-
-    Rules:
-    1. Return ONLY a valid JSON object
-    2. Map source columns to standard columns based on best match
-    3. Use exact matches when possible
-    4. Use semantic matching for unclear cases
-    5. Include only valid mappings
-    6. If no valid mappings are found, return an empty JSON object {{}}
+    # Validate mappings
+    valid_mappings = {}
+    for source, target in mappings.items():
+        if target in standard_columns.keys():
+            # Find the original header index from cleaned headers
+            try:
+                original_idx = cleaned_headers.index(source)
+                original_header = headers[original_idx]
+                # Convert nan to string representation if needed
+                if pd.isna(original_header):
+                    original_header = f"Column {original_idx + 1}"
+                valid_mappings[str(original_header)] = target
+            except ValueError:
+                continue
 
-    Example response format:
-    {{"source_column1": "Export Invoice #", "source_column2": "Style"}}
-    """
-
-    response = client.chat.completions.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are a precise data mapping assistant. Respond only with valid JSON."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0,
-        max_tokens=300,
-        n=1,
-    )
-
-    try:
-        mappings = json.loads(response.choices[0].message.content.strip())
-        
-        # Validate mappings
-        valid_mappings = {}
-        for source, target in mappings.items():
-            if target in standard_columns.keys():
-                # Find the original header index from cleaned headers
-                try:
-                    original_idx = cleaned_headers.index(source)
-                    original_header = headers[original_idx]
-                    # Convert nan to string representation if needed
-                    if pd.isna(original_header):
-                        original_header = f"Column {original_idx + 1}"
-                    valid_mappings[str(original_header)] = target
-                except ValueError:
-                    continue
-        
-        return valid_mappings
-
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse JSON response from OpenAI: {e}")
-        logger.error(f"Raw content: {response.choices[0].message.content}")
-        return {}
+    return valid_mappings
@@ -1,8 +1,18 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from .services.processing import process_invoice
+from .services.processing import (
+    load_invoice,
+    process_invoice,
+    submit_invoice_batch,
+    get_batch_job,
+    finalize_batch_jobs,
+    create_signed_url,
+    http_client,
+)
 from .core.config import settings
+import asyncio
 import logging
 
 # Set up logging
@@ -20,26 +30,83 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
 class ProcessRequest(BaseModel):
     fileUrl: str
     userId: str
     originalFileName: str
+    useBatchApi: bool = False
 
 @app.post("/api/process")
 async def process_file(request: ProcessRequest):
     """
     Process an invoice file from Supabase storage.
     Returns the URL where the processed file can be downloaded.
+
+    With useBatchApi, unit of measure lookups are queued on the OpenAI Batch API
+    instead and a 202 with the batch ID is returned; poll /api/batches/{batchId}
+    for the processed file.
     """
     try:
         logger.info(f"Processing request: {request}")
+
+        standardized_df = None
+        if request.useBatchApi:
+            standardized_df = await load_invoice(request.fileUrl, request.originalFileName)
+            batch_id = await submit_invoice_batch(
+                standardized_df,
+                request.fileUrl,
+                request.userId,
+                request.originalFileName
+            )
+            if batch_id is not None:
+                return JSONResponse(status_code=202, content={"batchId": batch_id})
         
+        # When every HS Code was already cached, the invoice loaded above is reused
         processed_file_url = await process_invoice(
             request.fileUrl,
             request.userId,
-            request.originalFileName
+            request.originalFileName,
+            standardized_df
         )
         return {"fileUrl": processed_file_url}
     except Exception as e:
         logger.error(f"Error processing file: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    """
+    Return the status of an invoice queued with useBatchApi, and the processed
+    file URL once it has completed.
+    """
+    job = await get_batch_job(batch_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown batch: {batch_id}")
+
+    # Sign the processed file on every read, so the URL is always fresh
+    file_url = None
+    if job.get("processed_file_path"):
+        file_url = await asyncio.to_thread(create_signed_url, job["processed_file_path"])
+
+    return {
+        "batchId": job["batch_id"],
+        "status": job["status"],
+        "fileUrl": file_url,
+        "error": job.get("error"),
+    }
+
+@app.post("/api/batches/finalize")
+async def finalize_batches():
+    """
+    Finish invoices whose OpenAI batches have completed. Meant to be called by a cron job.
+    """
+    try:
+        finalized = await finalize_batch_jobs()
+        return {"finalized": finalized}
+    except Exception as e:
+        logger.error(f"Error finalizing batches: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
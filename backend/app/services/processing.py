@@ -1,108 +1,216 @@
 # app/services/processing.py
 
+import numpy as np
 import pandas as pd
 from ..core.config import settings
 from ..core.supabase import supabase
-from ..core.openai_client import get_column_mappings, get_unit_of_measure_cached
+from ..core.openai_client import (
+    get_column_mappings,
+    get_units_of_measure_cached,
+    get_uncached_hs_codes,
+    cache_units_of_measure,
+)
+from ..core.openai_batch import submit_hs_batch, cancel_batch, poll_batch, fetch_results, FAILED_BATCH_STATUSES
+import io
 import tempfile
+import asyncio
 import os
-from datetime import datetime
+from typing import Dict, List, Optional
+from urllib.parse import unquote, urlparse
 import logging
 import httpx
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import xlsxwriter
 
 logger = logging.getLogger(__name__)
 
-# Create a ThreadPoolExecutor for running synchronous functions
-executor = ThreadPoolExecutor(max_workers=10)
+# calamine (Rust) reads both .xlsx and .xls far faster than openpyxl/xlrd
+try:
+    import python_calamine  # noqa: F401
+    HAS_CALAMINE = True
+except ImportError:
+    HAS_CALAMINE = False
+
+# Supabase table tracking invoices waiting on an OpenAI Batch API job
+BATCH_JOBS_TABLE = 'processing_jobs'
+
+# Shared HTTP client so connections to Supabase storage are kept alive across invoices.
+# Closed on application shutdown.
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+
+# Bytes read at a time when downloading an invoice
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
-def calculate_customs_quantity(invoice_quantity: float, unit_of_measure: str) -> float:
+# Rows converted for writing at a time by write_excel
+EXCEL_WRITE_CHUNK_ROWS = 10_000
+
+# Content type of the processed xlsx files
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Number of invoice units per customs unit of measure
+UNIT_FACTORS = pd.Series({
+    "DOZ": 12,
+    "NUM": 1,
+    "KG": 1,
+    "LBS": 1,
+})
+
+def categorize_hs_codes(hs_column: pd.Series) -> pd.Series:
     """
-    Calculate Customs Quantity based on Invoice Quantity and Unit of Measure.
+    Convert the HS Code column to strings once, as a categorical, so unit lookups
+    only work over its unique values. Missing codes become ''.
     """
-    # Handle None or NaN values
-    if pd.isna(invoice_quantity):
-        return 0.0
+    return hs_column.astype('string').fillna('').astype('category')
 
+def excel_engine(file_extension: str) -> str:
+    """
+    Return the pandas engine for reading an Excel file, preferring calamine when installed.
+    """
+    if HAS_CALAMINE:
+        return 'calamine'
+    return 'openpyxl' if file_extension == '.xlsx' else 'xlrd'
+
+def dedupe_column_names(names: List[str]) -> List[str]:
+    """
+    Suffix repeated column names with .1, .2, ... as pandas does when reading a
+    header row, so every column can be selected on its own.
+    """
+    counts: Dict[str, int] = {}
+    deduped = []
+    for name in names:
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[name] = count + 1
+            name = f"{name}.{count}"
+            count = counts.get(name, 0)
+        counts[name] = counts.get(name, 0) + 1
+        deduped.append(name)
+    return deduped
+
+def read_invoice_sheet(path: str, engine: str) -> pd.DataFrame:
+    """
+    Read an invoice workbook and return the rows below its header row, which is
+    the row containing 'EAN Code'. Blocking and CPU-bound, so callers on the event
+    loop run it in a thread.
+    """
+    # Types are inferred once the header row is known, so skip inference here
+    df = pd.read_excel(path, engine=engine, header=None, dtype=object)
+
+    # Find the row containing 'EAN Code' which indicates our header row
+    is_header_row = df.eq('EAN Code').to_numpy().any(axis=1)
+    if not is_header_row.any():
+        raise ValueError("Could not find header row with 'EAN Code'")
+    header_row = int(is_header_row.argmax())
+    logger.info(f"Found headers at row {header_row}")
+
+    # Use that row as the header and keep the rows below it, instead of parsing the file again.
+    # Names are cleaned up (whitespace removed) as they are built; blank headers are named
+    # like pandas does when reading with a header row
+    header = df.iloc[header_row]
+    df = df.iloc[header_row + 1:].reset_index(drop=True)
+    df.columns = dedupe_column_names(
+        [str(name).strip() if pd.notna(name) else f"Unnamed: {idx}" for idx, name in enumerate(header)]
+    )
+
+    # Arrow-backed dtypes take far less memory than object columns. Columns with
+    # mixed types are left as object.
+    return df.convert_dtypes(dtype_backend='pyarrow')
+
+def write_excel(df: pd.DataFrame) -> bytes:
+    """
+    Serialize a DataFrame to xlsx in memory. Blocking, so callers on the event loop run it in a thread.
+
+    xlsxwriter's constant_memory mode flushes each row once the next one starts, so memory
+    does not grow with the row count. It requires writing row by row, which DataFrame.to_excel
+    does not do, so rows are written directly, EXCEL_WRITE_CHUNK_ROWS at a time.
+    """
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, df.columns)
+
+    # Rows are converted to Python objects one slice at a time, so the copy stays bounded.
+    # Missing values become blank cells
+    for start in range(0, len(df), EXCEL_WRITE_CHUNK_ROWS):
+        chunk = df.iloc[start:start + EXCEL_WRITE_CHUNK_ROWS]
+        rows = chunk.astype(object).where(chunk.notna(), None)
+        for row_idx, row in enumerate(rows.itertuples(index=False), start=start + 1):
+            worksheet.write_row(row_idx, 0, row)
+
+    workbook.close()
+    return buffer.getvalue()
+
+def remove_temp_file(path: str) -> None:
+    """
+    Delete a temporary file if it still exists, logging rather than raising on failure.
+    """
     try:
-        invoice_quantity = float(invoice_quantity)
-    except (ValueError, TypeError):
-        logger.error(f"Invalid invoice quantity: {invoice_quantity}")
-        return 0.0
-
-    unit_factors = {
-        "DOZ": 12,
-        "NUM": 1,
-        "KG": 1,
-        "LBS": 1,
-    }
-    factor = unit_factors.get(unit_of_measure, 1)
-    
-    try:
-        return invoice_quantity / factor
+        if os.path.exists(path):
+            os.unlink(path)
     except Exception as e:
-        logger.error(f"Error calculating customs quantity: {e}")
-        return 0.0
+        logger.error(f"Error cleaning up temporary files: {str(e)}")
 
-async def process_invoice(file_url: str, user_id: str, original_filename: str) -> str:
+def create_signed_url(path: str) -> str:
     """
-    Process an invoice file from Supabase storage and return the URL of the processed file.
+    Create a signed URL, valid for one hour, for a file in the invoices bucket.
+    """
+    signed_url_result = supabase.storage.from_('invoices').create_signed_url(
+        path=path,
+        expires_in=3600
+    )
+
+    if isinstance(signed_url_result, dict) and 'signedURL' in signed_url_result:
+        return signed_url_result['signedURL']
+
+    logger.error(f"Unexpected signed URL result format: {signed_url_result}")
+    raise Exception("Failed to generate valid signed URL")
+
+def storage_path_from_signed_url(file_url: str) -> str:
+    """
+    Recover the invoices bucket path from a Supabase signed URL, so a fresh
+    URL can be signed once the original one has expired.
+    """
+    url_path = unquote(urlparse(file_url).path)
+    marker = '/object/sign/invoices/'
+    if marker not in url_path:
+        raise ValueError(f"Not a signed URL for the invoices bucket: {file_url}")
+    return url_path.split(marker, 1)[1]
+
+async def load_invoice(file_url: str, original_filename: str) -> pd.DataFrame:
+    """
+    Download an invoice file and map its columns to the standard columns.
 
     Args:
         file_url (str): The signed URL of the original invoice file.
-        user_id (str): The ID of the user processing the file.
         original_filename (str): The original filename of the invoice.
 
     Returns:
-        str: The public URL of the processed invoice file.
+        pd.DataFrame: The invoice rows under the standard column names.
     """
-    logger.info(f"Starting to process file: {file_url}")
-
+    temp_path = None
     try:
-        loop = asyncio.get_running_loop()
-
-        # Download file using the signed URL directly
-        async with httpx.AsyncClient() as client_http:
-            logger.info("Downloading from signed URL")
-            response = await client_http.get(file_url)
-            response.raise_for_status()
-            file_content = response.content
-
         # Determine file extension
         file_extension = '.xlsx' if original_filename.endswith('.xlsx') else '.xls'
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_path = temp_file.name
-            logger.info(f"Saved temporary file to: {temp_path}")
 
-        # Read the Excel file with appropriate engine
+        # Download file using the signed URL directly, streaming it to disk in chunks
+        logger.info("Downloading from signed URL")
+        async with http_client.stream("GET", file_url) as response:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
+                temp_path = temp_file.name
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    temp_file.write(chunk)
+        logger.info(f"Saved temporary file to: {temp_path}")
+
+        # Read the Excel file with appropriate engine, off the event loop
         logger.info("Reading Excel file and identifying headers")
-        engine = 'openpyxl' if file_extension == '.xlsx' else 'xlrd'
-        df = pd.read_excel(temp_path, engine=engine, header=None)
-        
-        # Find the row containing 'EAN Code' which indicates our header row
-        header_row = None
-        for idx, row in df.iterrows():
-            if 'EAN Code' in row.values:
-                header_row = idx
-                break
-        
-        if header_row is None:
-            raise ValueError("Could not find header row with 'EAN Code'")
-        
-        # Read the file again, but now with the correct header row
-        df = pd.read_excel(temp_path, engine=engine, skiprows=header_row)
+        df = await asyncio.to_thread(read_invoice_sheet, temp_path, excel_engine(file_extension))
         
-        # Clean up column names (remove any whitespace)
-        df.columns = df.columns.str.strip()
-        
-        logger.info(f"Found headers at row {header_row}")
         logger.info(f"Actual columns found: {df.columns.tolist()}")
         
-        # Create the standardized DataFrame with direct mappings
-        standardized_df = pd.DataFrame()
-        
         # Direct column mappings
         column_mappings = {
             'Style': 'Product Code',
@@ -113,19 +221,24 @@ async def process_invoice(file_url: str, user_id: str, original_filename: str) -
             'Total Amount': 'Total Amount'
         }
         
-        # Apply the mappings and log each mapping attempt
-        for source_col, target_col in column_mappings.items():
-            if source_col in df.columns:
-                logger.info(f"Mapping column {source_col} to {target_col}")
-                standardized_df[target_col] = df[source_col]
-            else:
-                logger.error(f"Missing column: {source_col}")
-                logger.info(f"Available columns: {df.columns.tolist()}")
-                standardized_df[target_col] = None
+        # Log all missing source columns at once
+        present_columns = set(df.columns)
+        missing_source_columns = [col for col in column_mappings if col not in present_columns]
+        if missing_source_columns:
+            logger.error(f"Missing columns: {missing_source_columns}. Available columns: {df.columns.tolist()}")
+
+        # Create the standardized DataFrame with direct mappings in a single constructor call;
+        # missing source columns are left empty. The columns share df's index, so nothing is
+        # realigned, and copy=False reuses their arrays instead of copying each one
+        standardized_df = pd.DataFrame({
+            target_col: df[source_col] if source_col in present_columns else None
+            for source_col, target_col in column_mappings.items()
+        }, index=df.index, copy=False)
         
-        # Add debug logging
-        logger.info(f"Original DataFrame sample:\n{df.head()}")
-        logger.info(f"Standardized DataFrame sample:\n{standardized_df.head()}")
+        # Debug logging; formatting DataFrame samples is costly, so only when DEBUG is enabled
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Original DataFrame sample:\n{df.head()}")
+            logger.debug(f"Standardized DataFrame sample:\n{standardized_df.head()}")
         
         # Ensure we have data
         if standardized_df.empty:
@@ -145,115 +258,237 @@ async def process_invoice(file_url: str, user_id: str, original_filename: str) -
         if missing_columns:
             raise ValueError(f"Missing required columns: {missing_columns}")
 
-        # Determine Customs Unit of Measure based on HS Code
-        logger.info("Determining Customs Unit of Measure based on HS Code")
-        hs_codes = standardized_df['HS Code'].astype(str).unique().tolist()
-
-        # Create a mapping from HS Code to Unit of Measure using the cached function
-        tasks = []
-        for hs in hs_codes:
-            tasks.append(loop.run_in_executor(
-                executor,
-                get_unit_of_measure_cached,
-                hs
-            ))
-        units = await asyncio.gather(*tasks)
-        hs_to_unit = dict(zip(hs_codes, units))
-
-        # Apply the HS Code to Unit of Measure mapping
-        standardized_df['Customs Unit of Measure'] = standardized_df['HS Code'].astype(str).map(hs_to_unit)
-
-        # Calculate Customs Quantity
-        logger.info("Calculating Customs Quantity")
-        standardized_df['Customs Quantity'] = standardized_df.apply(
-            lambda row: calculate_customs_quantity(row['Invoice Quantity'], row['Customs Unit of Measure']),
-            axis=1
+        return standardized_df
+
+    finally:
+        # Clean up the downloaded file in the background, without holding up the caller
+        if temp_path is not None:
+            asyncio.get_running_loop().run_in_executor(None, remove_temp_file, temp_path)
+
+async def export_invoice(standardized_df: pd.DataFrame, user_id: str, original_filename: str) -> str:
+    """
+    Derive the customs columns for a loaded invoice and upload the processed file.
+
+    Args:
+        standardized_df (pd.DataFrame): The invoice rows under the standard column names.
+        user_id (str): The ID of the user processing the file.
+        original_filename (str): The original filename of the invoice.
+
+    Returns:
+        str: The storage path of the processed file in the invoices bucket.
+    """
+    # Determine Customs Unit of Measure based on HS Code
+    logger.info("Determining Customs Unit of Measure based on HS Code")
+    hs_cat = categorize_hs_codes(standardized_df['HS Code'])
+    hs_codes = hs_cat.cat.categories.tolist()
+
+    # Create a mapping from HS Code to Unit of Measure with a single batched lookup
+    hs_to_unit = await get_units_of_measure_cached(hs_codes)
+
+    # Apply the HS Code to Unit of Measure mapping over the unique codes only.
+    # Units repeat heavily, so they are kept as a categorical
+    standardized_df['Customs Unit of Measure'] = hs_cat.map(hs_to_unit).astype('category')
+
+    # Calculate Customs Quantity
+    logger.info("Calculating Customs Quantity")
+    # Convert to a plain float64 array first: on Arrow-backed columns to_numeric keeps
+    # unparseable values as NaN rather than NA, which isna() and fillna() do not see
+    quantities = pd.to_numeric(standardized_df['Invoice Quantity'], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    missing_quantity = np.isnan(quantities)
+    invalid_quantity = missing_quantity & standardized_df['Invoice Quantity'].notna().to_numpy()
+    if invalid_quantity.any():
+        logger.error(f"Invalid invoice quantities: {standardized_df.loc[invalid_quantity, 'Invoice Quantity'].tolist()}")
+
+    # Missing or invalid quantities count as 0, unknown or missing units as a factor of 1.
+    # Factors are looked up once per unit category and indexed by the category codes;
+    # the trailing 1 is picked by the -1 code of missing units
+    units = standardized_df['Customs Unit of Measure'].cat
+    category_factors = UNIT_FACTORS.reindex(units.categories).fillna(1).to_numpy(dtype='float64')
+    quantities = np.where(missing_quantity, 0.0, quantities)
+    if (category_factors == 1).all():
+        # Every unit present counts items one to one, so there is nothing to divide
+        standardized_df['Customs Quantity'] = quantities
+    else:
+        factors = np.append(category_factors, 1.0)[units.codes.to_numpy()]
+        standardized_df['Customs Quantity'] = quantities / factors
+
+    # Select and order the required columns
+    output_columns = [
+        "Export Invoice #",
+        "Product Code",
+        "Description",
+        "Invoice Quantity",
+        "Total Amount",
+        "Customs Unit of Measure",
+        "Customs Quantity",
+        "HS Code"
+    ]
+    standardized_df = standardized_df[output_columns]
+
+    # Determine output format (always save as xlsx)
+    output_filename = os.path.splitext(original_filename)[0] + '.xlsx'
+
+    try:
+        # Serialize to Excel (xlsx format) in memory, off the event loop
+        output_content = await asyncio.to_thread(write_excel, standardized_df)
+        logger.info(f"Serialized processed file ({len(output_content)} bytes)")
+    except Exception as e:
+        logger.error(f"Error saving Excel file: {e}")
+        raise
+
+    # Upload processed file to Supabase straight from memory
+    try:
+        # Use the uploads folder since we know it works for the initial file
+        processed_file_path = f'uploads/{user_id}/processed_{output_filename}'
+        logger.info(f"Uploading to Supabase: {processed_file_path}")
+
+        # The Supabase client is synchronous, so run it in a thread
+        result = await asyncio.to_thread(
+            supabase.storage.from_('invoices').upload,
+            path=processed_file_path,
+            file=output_content,
+            file_options={"content-type": XLSX_CONTENT_TYPE}
         )
+        logger.info(f"Upload successful: {result}")
 
-        # Select and order the required columns
-        output_columns = [
-            "Export Invoice #",
-            "Product Code",
-            "Description",
-            "Invoice Quantity",
-            "Total Amount",
-            "Customs Unit of Measure",
-            "Customs Quantity",
-            "HS Code"
-        ]
-        standardized_df = standardized_df[output_columns]
+    except Exception as e:
+        logger.error(f"Error uploading to Supabase: {str(e)}")
+        raise Exception(f"Failed to upload processed file: {str(e)}")
 
-        # Generate output filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_filename = f"processed_{timestamp}_{original_filename}"
+    return processed_file_path
 
-        # Save to temporary file
-        output_path = os.path.join(tempfile.gettempdir(), output_filename)
+async def process_invoice(
+    file_url: str,
+    user_id: str,
+    original_filename: str,
+    standardized_df: Optional[pd.DataFrame] = None
+) -> str:
+    """
+    Process an invoice file from Supabase storage and return the URL of the processed file.
 
-        # Determine output format (always save as xlsx)
-        output_filename = os.path.splitext(original_filename)[0] + '.xlsx'
-        output_path = os.path.join(tempfile.gettempdir(), output_filename)
+    Args:
+        file_url (str): The signed URL of the original invoice file.
+        user_id (str): The ID of the user processing the file.
+        original_filename (str): The original filename of the invoice.
+        standardized_df (Optional[pd.DataFrame]): The invoice as already returned by
+            load_invoice, to skip downloading and parsing it again.
 
-        try:
-            # Save to Excel (xlsx format)
-            with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-                standardized_df.to_excel(writer, index=False)
-            logger.info(f"Saved processed file to: {output_path}")
-        except Exception as e:
-            logger.error(f"Error saving Excel file: {e}")
-            raise
+    Returns:
+        str: The public URL of the processed invoice file.
+    """
+    logger.info(f"Starting to process file: {file_url}")
 
-        # Upload processed file to Supabase
-        try:
-            with open(output_path, 'rb') as f:
-                # Use the uploads folder since we know it works for the initial file
-                processed_file_path = f'uploads/{user_id}/processed_{output_filename}'
-                logger.info(f"Uploading to Supabase: {processed_file_path}")
-                
-                # Upload with minimal options
-                result = supabase.storage.from_('invoices').upload(
-                    path=processed_file_path,
-                    file=f
-                )
-                logger.info(f"Upload successful: {result}")
+    try:
+        if standardized_df is None:
+            standardized_df = await load_invoice(file_url, original_filename)
 
-        except Exception as e:
-            logger.error(f"Error uploading to Supabase: {str(e)}")
-            raise Exception(f"Failed to upload processed file: {str(e)}")
+        processed_file_path = await export_invoice(standardized_df, user_id, original_filename)
 
         # Get signed URL for the processed file
         try:
-            signed_url_result = supabase.storage.from_('invoices').create_signed_url(
-                path=processed_file_path,
-                expires_in=3600
-            )
-            
-            if isinstance(signed_url_result, dict) and 'signedURL' in signed_url_result:
-                signed_url = signed_url_result['signedURL']
-                logger.info(f"Generated signed URL successfully")
-                return signed_url
-            else:
-                logger.error(f"Unexpected signed URL result format: {signed_url_result}")
-                raise Exception("Failed to generate valid signed URL")
+            # Synchronous Supabase call, so run it in a thread
+            signed_url = await asyncio.to_thread(create_signed_url, processed_file_path)
+            logger.info(f"Generated signed URL successfully")
+            return signed_url
         
         except Exception as url_error:
             logger.error(f"Error getting signed URL: {str(url_error)}")
             raise Exception(f"Failed to generate signed URL: {str(url_error)}")
 
-        # Add after the mappings are created:
-        logger.info("Original columns:", df.columns.tolist())
-        logger.info("Reverse mappings:", reverse_mappings)
-        logger.info("Final columns in standardized_df:", standardized_df.columns.tolist())
-
     except Exception as e:
         logger.error(f"Error in processing: {str(e)}", exc_info=True)
         raise
-    finally:
-        # Clean up temporary files
+
+async def submit_invoice_batch(
+    standardized_df: pd.DataFrame,
+    file_url: str,
+    user_id: str,
+    original_filename: str
+) -> Optional[str]:
+    """
+    Queue the HS Code unit of measure lookups for an invoice on the OpenAI Batch API.
+    The invoice is finished later by finalize_batch_jobs once the batch completes.
+
+    Args:
+        standardized_df (pd.DataFrame): The invoice as returned by load_invoice.
+        file_url (str): The signed URL of the original invoice file.
+        user_id (str): The ID of the user processing the file.
+        original_filename (str): The original filename of the invoice.
+
+    Returns:
+        Optional[str]: The batch ID, or None if every HS Code is already cached
+        and the invoice can be processed in real time.
+    """
+    hs_codes = categorize_hs_codes(standardized_df['HS Code']).cat.categories.tolist()
+    # Blank codes default to NUM without a lookup, so they are never sent to the batch
+    misses = [hs_code for hs_code in get_uncached_hs_codes(hs_codes) if hs_code.strip()]
+    if not misses:
+        return None
+
+    # Resolved before submitting, so a bad URL fails before a billed batch is created
+    file_path = storage_path_from_signed_url(file_url)
+    batch_id = await submit_hs_batch(misses)
+
+    # Supabase table calls are synchronous HTTP, so they run in a thread
+    try:
+        await asyncio.to_thread(supabase.table(BATCH_JOBS_TABLE).insert({
+            'batch_id': batch_id,
+            'user_id': user_id,
+            'file_path': file_path,
+            'original_filename': original_filename,
+            'status': 'pending',
+        }).execute)
+    except Exception:
+        # Without a job row the batch would never be finalized
         try:
-            if 'temp_path' in locals() and os.path.exists(temp_path):
-                os.unlink(temp_path)
-            if 'output_path' in locals() and os.path.exists(output_path):
-                os.unlink(output_path)
+            await cancel_batch(batch_id)
         except Exception as e:
-            logger.error(f"Error cleaning up temporary files: {str(e)}")
+            logger.error(f"Error cancelling untracked batch {batch_id}: {str(e)}")
+        raise
+    return batch_id
+
+async def get_batch_job(batch_id: str) -> Optional[Dict]:
+    """
+    Return the stored job for a batch, or None if there is no such job.
+    """
+    result = await asyncio.to_thread(supabase.table(BATCH_JOBS_TABLE).select('*').eq('batch_id', batch_id).execute)
+    return result.data[0] if result.data else None
+
+async def finalize_batch_jobs() -> int:
+    """
+    Finish every pending invoice whose batch has completed. Intended to be called
+    periodically (e.g. by a cron job).
+
+    Returns:
+        int: The number of jobs that were completed or marked as failed.
+    """
+    jobs = (await asyncio.to_thread(supabase.table(BATCH_JOBS_TABLE).select('*').eq('status', 'pending').execute)).data
+    finalized = 0
+
+    for job in jobs:
+        batch_id = job['batch_id']
+        try:
+            status = await poll_batch(batch_id)
+            if status in FAILED_BATCH_STATUSES:
+                raise Exception(f"Batch ended with status '{status}'")
+            if status != 'completed':
+                continue
+
+            # With the batch results cached, processing makes no real-time unit lookups
+            cache_units_of_measure(await fetch_results(batch_id))
+            standardized_df = await load_invoice(
+                await asyncio.to_thread(create_signed_url, job['file_path']),
+                job['original_filename']
+            )
+            # Store the path rather than a signed URL, which would expire; a fresh URL
+            # is signed whenever the job is read
+            processed_file_path = await export_invoice(standardized_df, job['user_id'], job['original_filename'])
+            update = {'status': 'completed', 'processed_file_path': processed_file_path}
+        except Exception as e:
+            logger.error(f"Error finalizing batch {batch_id}: {str(e)}", exc_info=True)
+            update = {'status': 'failed', 'error': str(e)}
+
+        await asyncio.to_thread(supabase.table(BATCH_JOBS_TABLE).update(update).eq('batch_id', batch_id).execute)
+        finalized += 1
+
+    return finalized